@@ -0,0 +1,47 @@
+## Content-defined chunking
+#  The per-byte rolling hash loop that finds chunk boundaries, compiled with Numba when it is installed.
+#  Without Numba the same function runs as plain Python. The compiled kernel releases the GIL (nogil), so files chunk in parallel on the diff pool.
+try:
+    import numpy as np
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    np = None
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        def decorator(fn):
+            return fn
+        return decorator
+
+
+@njit(cache=True, nogil=True)
+def cut_points(buf, B, Bw, p, W, mask, min_size, max_size):
+    """Return the end offset of every chunk of buf; a chunk ends where the hash of its last W bytes has no bit of mask set."""
+    cuts = []
+    n = len(buf)
+    start = 0
+    while start < n:
+        end = min(start + max_size, n)
+        pos = start + min_size
+        if pos >= end:
+            cuts.append(end)
+            start = end
+            continue
+        # Horner's method over the window ending at the first allowed cut
+        h = 0
+        for i in range(pos - W, pos):
+            h = (h * B + buf[i]) % p
+        while pos < end and (h & mask) != 0:
+            h = (h * B + buf[pos] - buf[pos - W] * Bw) % p
+            pos += 1
+        cuts.append(pos)
+        start = pos
+    return cuts
+
+
+def find_cut_points(view, B, Bw, p, W, mask, min_size, max_size):
+    """Run cut_points over a buffer, converting it to an array first when Numba is used."""
+    if HAVE_NUMBA:
+        return cut_points(np.frombuffer(view, dtype=np.uint8), B, Bw, p, W, mask, min_size, max_size)
+    return cut_points(view, B, Bw, p, W, mask, min_size, max_size)
@@ -1,16 +1,61 @@
 import os
+import mmap
 import shutil
-import pathlib
 import hashlib
-import pickle
 import json
-# import protobuf
+import logging
+import struct
+import sys
 from enum import Enum
+import itertools
 import tempfile
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from typing import *
 
-# BLOCK_SIZE is the size of the blocks used to compute the block library
-BLOCK_SIZE = 8
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+from _scan import find_cut_points
+
+logger = logging.getLogger(__name__)
+
+# Files are cut into content-defined chunks: a chunk ends where the rolling hash of its last CHUNK_WINDOW bytes
+# has no bit of CHUNK_MASK set, so boundaries move with the content instead of shifting after an insertion.
+# CHUNK_MASK gives an average chunk of 8 KiB, CHUNK_MIN_SIZE and CHUNK_MAX_SIZE bound it.
+# Matching is per whole chunk, not per byte: any edit resends every chunk it touches as DATA, 2-64 KiB each,
+# where the old byte-level rolling match only resent the edited bytes.
+CHUNK_WINDOW = 48
+CHUNK_MASK = (1 << 13) - 1
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_MAX_SIZE = 64 * 1024
+
+# Rolling hash over the CHUNK_WINDOW bytes before a candidate cut, updated one byte at a time:
+# h = (h*ROLLING_BASE + new_byte - old_byte*ROLLING_BASE^W) mod ROLLING_PRIME
+ROLLING_BASE = 257
+ROLLING_PRIME = 1000000007
+# Weight of the byte leaving the window, computed once
+ROLLING_BASE_POW = pow(ROLLING_BASE, CHUNK_WINDOW, ROLLING_PRIME)
+
+# STRONG_DIGEST_SIZE is the size in bytes of the strong hash that confirms a rolling hash match
+STRONG_DIGEST_SIZE = 16
+
+# COPY_CHUNK is the read size used when a block range has to be copied through user space
+COPY_CHUNK = 1 << 20
+
+# PARALLEL_HASH_CHUNKS is the number of chunks above which the strong hashes are computed on the thread pool
+PARALLEL_HASH_CHUNKS = 64
+
+# WORKERS is the number of threads used to diff common files and hash large ones, which is mostly I/O and hashlib work
+# Chunking only runs in parallel with Numba (nogil kernel); the pure-Python fallback of _scan.cut_points holds the GIL and stays serialized
+WORKERS = min(32, (os.cpu_count() or 1) * 2)
+
+# HASH_POOL hashes the chunks of large files; shared by every file so nested diffs don't each start WORKERS threads
+HASH_POOL = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='hash')
 
 # OperationType is an enumeration type that defines the different types of operations that can be performed when applying a patch. It could be defined as follows:
 class OperationType(Enum):
@@ -21,21 +66,66 @@ class OperationType(Enum):
     MKDIR = 5
 
 class Operation:
-    def __init__(self, op_type: OperationType, file_index: int = 0, block_index: int = 0, block_span: int = 0, data: bytes = b'', target_path: str = ''):
+    __slots__ = ('op_type', 'file_index', 'block_offset', 'block_length', 'data', 'target_path', 'src_path')
+
+    def __init__(self, op_type: OperationType, file_index: int = 0, block_offset: int = 0, block_length: int = 0, data: bytes = b'', target_path: str = '', src_path: str = ''):
         self.op_type = op_type
         self.file_index = file_index
-        self.block_index = block_index
-        self.block_span = block_span
+        # Byte range of the old file copied by a BLOCK_RANGE operation
+        self.block_offset = block_offset
+        self.block_length = block_length
         self.data = data
         self.target_path = target_path
-    
+        # DATA taken from this file of the patch's source_dir instead of data, copied when the patch is applied
+        self.src_path = src_path
+
+class OperationColumns:
+    """Operations stored column-wise, one typed array (or list) per Operation field instead of one object per operation."""
+    __slots__ = ('op_type', 'file_index', 'block_offset', 'block_length', 'data', 'target_path', 'src_path')
+
+    def __init__(self):
+        self.op_type = array('B')
+        self.file_index = array('q')
+        self.block_offset = array('q')
+        self.block_length = array('q')
+        self.data = []
+        self.target_path = []
+        self.src_path = []
+
+    def __len__(self):
+        return len(self.op_type)
+
+    def __getitem__(self, i: int) -> Operation:
+        return Operation(OperationType(self.op_type[i]), self.file_index[i], self.block_offset[i], self.block_length[i], self.data[i], self.target_path[i], self.src_path[i])
+
+    def __iter__(self) -> Iterator[Operation]:
+        for i in range(len(self.op_type)):
+            yield self[i]
+
+    def append(self, operation: Operation):
+        self.op_type.append(operation.op_type.value)
+        self.file_index.append(operation.file_index)
+        self.block_offset.append(operation.block_offset)
+        self.block_length.append(operation.block_length)
+        self.data.append(operation.data)
+        self.target_path.append(operation.target_path)
+        self.src_path.append(operation.src_path)
+
+    def extend(self, operations: Iterable[Operation]):
+        for operation in operations:
+            self.append(operation)
+
 class Patch:
-    def __init__(self, old_dirs, new_dirs, deleted_files, extra_files, operations):
+    __slots__ = ('old_dirs', 'new_dirs', 'deleted_files', 'extra_files', 'operations', 'source_dir')
+
+    def __init__(self, old_dirs, new_dirs, deleted_files, extra_files, operations: OperationColumns, source_dir: str = ''):
         self.old_dirs = old_dirs
         self.new_dirs = new_dirs
         self.deleted_files = deleted_files
         self.extra_files = extra_files
         self.operations = operations
+        # Directory the operations' src_path refer to, the new directory of the diff
+        self.source_dir = source_dir
 
 
 
@@ -47,6 +137,124 @@ class PatchApplyError(Exception):
         self.file = file
         self.operation = operation
 
+class PatchFormatError(Exception):
+    pass
+
+
+## Serialization
+#  A patch file is a header followed by length-prefixed sections: the string lists, one packed little-endian
+#  array per operation column, the offsets of every op's data and the concatenated data blob.
+PATCH_MAGIC = b'DPAT'
+PATCH_VERSION = 1
+PATCH_HEADER = struct.Struct('<4sBQ')
+SECTION_LENGTH = struct.Struct('<Q')
+OPERATION_TYPE_VALUES = frozenset(op_type.value for op_type in OperationType)
+
+def pack_strings(strings: List[str]) -> bytes:
+    # surrogateescape round-trips POSIX file names that are not valid UTF-8, like os.fsencode
+    return SECTION_LENGTH.pack(len(strings)) + '\0'.join(strings).encode('utf-8', 'surrogateescape')
+
+def unpack_strings(section: memoryview) -> List[str]:
+    if len(section) < SECTION_LENGTH.size:
+        raise PatchFormatError('Truncated string section')
+    count, = SECTION_LENGTH.unpack_from(section)
+    return str(section[SECTION_LENGTH.size:], 'utf-8', 'surrogateescape').split('\0') if count else []
+
+def pack_ints(values: array) -> bytes:
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def unpack_ints(typecode: str, section: memoryview) -> array:
+    values = array(typecode)
+    if len(section) % values.itemsize:
+        raise PatchFormatError('Integer section is not a whole number of items')
+    values.frombytes(section)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def dump_patch(patch: Patch, f: BinaryIO):
+    """Write a patch to a binary file; DATA read from the source directory is embedded so the file is self-contained."""
+    ops = patch.operations
+    source_prefix = os.path.join(patch.source_dir, '')
+    data_lengths = [os.path.getsize(source_prefix + src_path) if src_path else len(data) for data, src_path in zip(ops.data, ops.src_path)]
+    data_offsets = array('q', [0])
+    for length in data_lengths:
+        data_offsets.append(data_offsets[-1] + length)
+    sections = [
+        pack_strings(list(patch.old_dirs)),
+        pack_strings(list(patch.new_dirs)),
+        pack_strings(list(patch.deleted_files)),
+        pack_strings(list(patch.extra_files)),
+        pack_strings(ops.target_path),
+        pack_ints(ops.op_type),
+        pack_ints(ops.file_index),
+        pack_ints(ops.block_offset),
+        pack_ints(ops.block_length),
+        pack_ints(data_offsets),
+    ]
+    f.write(PATCH_HEADER.pack(PATCH_MAGIC, PATCH_VERSION, len(ops)))
+    for section in sections:
+        f.write(SECTION_LENGTH.pack(len(section)))
+        f.write(section)
+    # The data blob is the last section, written buffer by buffer instead of joined
+    f.write(SECTION_LENGTH.pack(data_offsets[-1]))
+    for data, src_path, length in zip(ops.data, ops.src_path, data_lengths):
+        if not src_path:
+            f.write(data)
+            continue
+        with open(source_prefix + src_path, 'rb') as src_file:
+            while length:
+                chunk = src_file.read(min(length, COPY_CHUNK))
+                if not chunk:
+                    raise PatchFormatError(f'{src_path} shrank while the patch was written')
+                f.write(chunk)
+                length -= len(chunk)
+
+def load_patch(f: BinaryIO) -> Patch:
+    """Read a patch written by dump_patch; DATA payloads are memoryview slices of the file contents."""
+    view = memoryview(f.read())
+    if len(view) < PATCH_HEADER.size:
+        raise PatchFormatError('Truncated patch header')
+    magic, version, op_count = PATCH_HEADER.unpack_from(view)
+    if magic != PATCH_MAGIC or version != PATCH_VERSION:
+        raise PatchFormatError(f'Unsupported patch format {bytes(magic)!r} version {version}')
+    sections = []
+    pos = PATCH_HEADER.size
+    while pos < len(view):
+        if pos + SECTION_LENGTH.size > len(view):
+            raise PatchFormatError('Truncated patch section length')
+        length, = SECTION_LENGTH.unpack_from(view, pos)
+        pos += SECTION_LENGTH.size
+        if pos + length > len(view):
+            raise PatchFormatError('Truncated patch section')
+        sections.append(view[pos:pos + length])
+        pos += length
+    if len(sections) != 11:
+        raise PatchFormatError(f'Expected 11 sections, found {len(sections)}')
+    old_dirs, new_dirs, deleted_files, extra_files, target_paths = (unpack_strings(section) for section in sections[:5])
+    ops = OperationColumns()
+    ops.target_path = target_paths
+    ops.op_type = unpack_ints('B', sections[5])
+    ops.file_index = unpack_ints('q', sections[6])
+    ops.block_offset = unpack_ints('q', sections[7])
+    ops.block_length = unpack_ints('q', sections[8])
+    data_offsets = unpack_ints('q', sections[9])
+    if any(len(column) != op_count for column in (ops.target_path, ops.op_type, ops.file_index, ops.block_offset, ops.block_length)) or len(data_offsets) != op_count + 1:
+        raise PatchFormatError('Operation columns have different lengths')
+    if any(op_type not in OPERATION_TYPE_VALUES for op_type in ops.op_type):
+        raise PatchFormatError('Unknown operation type')
+    if any(value < 0 for value in ops.block_offset) or any(value < 0 for value in ops.block_length):
+        raise PatchFormatError('Negative block offset or length')
+    blob = sections[10]
+    if data_offsets[0] != 0 or data_offsets[-1] != len(blob) or any(data_offsets[i] > data_offsets[i + 1] for i in range(op_count)):
+        raise PatchFormatError('Data offsets do not match the data blob')
+    ops.data = [blob[data_offsets[i]:data_offsets[i + 1]] for i in range(op_count)]
+    ops.src_path = [''] * op_count
+    return Patch(old_dirs=old_dirs, new_dirs=new_dirs, deleted_files=deleted_files, extra_files=extra_files, operations=ops)
+
 
 import os
 from tempfile import TemporaryDirectory
@@ -54,184 +262,310 @@ from typing import List
 ### APPLY PATCH ###
 def create_missing_dirs(patch: Patch, staging_dir: str):
   """Create any missing directories in the staging directory."""
+  # Join the base once; patch paths are relative, so plain concatenation matches os.path.join
+  staging_prefix = os.path.join(staging_dir, '')
   for dir_path in patch.new_dirs:
-    os.makedirs(os.path.join(staging_dir, dir_path), exist_ok=True)
+    os.makedirs(staging_prefix + dir_path, exist_ok=True)
+
+def write_all(dst: BinaryIO, data: bytes):
+  """Write all of data to an unbuffered file, which may accept fewer bytes per call."""
+  view = memoryview(data)
+  while view:
+    view = view[dst.write(view):]
+
+def copy_range(src: BinaryIO, dst: BinaryIO, offset: int, count: int):
+  """Copy count bytes at offset of src to the current position of dst, inside the kernel when the platform allows it."""
+  src_fd, dst_fd = src.fileno(), dst.fileno()
+  if hasattr(os, 'copy_file_range'):
+    # Linux, may reflink on XFS/Btrfs; fails on some kernels/filesystems, the fallbacks pick up from there
+    try:
+      while count:
+        copied = os.copy_file_range(src_fd, dst_fd, count, offset)
+        if not copied:
+          break
+        offset += copied
+        count -= copied
+      else:
+        return
+    except OSError:
+      pass
+  if count and hasattr(os, 'sendfile'):
+    # Writes to a regular file on Linux, BSD/macOS only accept sockets and fail here
+    try:
+      while count:
+        copied = os.sendfile(dst_fd, src_fd, offset, count)
+        if not copied:
+          break
+        offset += copied
+        count -= copied
+      else:
+        return
+    except OSError:
+      pass
+  src.seek(offset)
+  while count:
+    chunk = src.read(min(count, COPY_CHUNK))
+    if not chunk:
+      break
+    write_all(dst, chunk)
+    count -= len(chunk)
+  if count:
+    raise PatchApplyError(f'{src.name} ends {count} bytes before the copied range', file=src.name)
 
 def apply_operations(patch: Patch, old_dir: str, staging_dir: str):
   """Apply the operations in the patch to the old directory and write the results to the staging directory."""
-  for operation in patch.operations:
-    print(f'Applying operation to {operation.target_path}', old_dir, staging_dir)
-    if operation.op_type == OperationType.DATA:
-      # Write the data to the new file
-      new_file_path = os.path.join(staging_dir, operation.target_path)
-      with open(new_file_path, 'wb') as f:
-        f.write(operation.data)
-    elif operation.op_type == OperationType.BLOCK_RANGE:
-      # Open the old file and seek to the correct offset
-      old_file_path = os.path.join(old_dir, operation.target_path)
-      with open(old_file_path, 'rb') as old_file:
-        old_file.seek(operation.block_index * BLOCK_SIZE)
-        # Read the specified number of blocks from the old file
-        data = old_file.read(operation.block_span * BLOCK_SIZE)
-      # Write the block range to the new file
-      new_file_path = os.path.join(staging_dir, operation.target_path)
-      with open(new_file_path, 'wb') as f:
-        f.write(data)
+  ops = patch.operations
+  op_types, block_offsets, block_lengths, datas, target_paths, src_paths = ops.op_type, ops.block_offset, ops.block_length, ops.data, ops.target_path, ops.src_path
+  data_type, block_range_type = OperationType.DATA.value, OperationType.BLOCK_RANGE.value
+  old_prefix, staging_prefix, source_prefix = os.path.join(old_dir, ''), os.path.join(staging_dir, ''), os.path.join(patch.source_dir, '')
+  debug = logger.isEnabledFor(logging.DEBUG)
+  # Group the operations by file; the sort is stable so each file keeps its operation order
+  order = sorted((i for i in range(len(op_types)) if op_types[i] == data_type or op_types[i] == block_range_type), key=target_paths.__getitem__)
+  for target_path, group in itertools.groupby(order, key=target_paths.__getitem__):
+    group = list(group)
+    old_file_path = old_prefix + target_path
+    new_file_path = staging_prefix + target_path
+    if len(group) == 1 and src_paths[group[0]]:
+      # A whole file of the source directory, shutil copies it in the kernel where it can
+      if debug:
+        logger.debug('Copying %s to %s', src_paths[group[0]], target_path)
+      shutil.copyfile(source_prefix + src_paths[group[0]], new_file_path)
+      continue
+    # Open the old file once for all of its block ranges, and write the new file in one go
+    needs_old = any(op_types[i] == block_range_type for i in group)
+    with (open(old_file_path, 'rb', buffering=0) if needs_old else nullcontext()) as old_file, open(new_file_path, 'wb', buffering=0) as f:
+      # Pending byte range of the old file, adjacent block ranges are merged into one copy
+      range_start = range_end = 0
+      for i in group:
+        if debug:
+          logger.debug('Applying %s operation to %s', OperationType(op_types[i]).name, target_path)
+        if op_types[i] == block_range_type:
+          if range_end != range_start and range_end == block_offsets[i]:
+            range_end += block_lengths[i]
+            continue
+          if range_end != range_start:
+            copy_range(old_file, f, range_start, range_end - range_start)
+          range_start, range_end = block_offsets[i], block_offsets[i] + block_lengths[i]
+        else:
+          if range_end != range_start:
+            copy_range(old_file, f, range_start, range_end - range_start)
+            range_start = range_end = 0
+          if src_paths[i]:
+            with open(source_prefix + src_paths[i], 'rb', buffering=0) as src_file:
+              copy_range(src_file, f, 0, os.fstat(src_file.fileno()).st_size)
+          else:
+            # Write the data to the new file
+            write_all(f, datas[i])
+      if range_end != range_start:
+        copy_range(old_file, f, range_start, range_end - range_start)
 
 
 def delete_extra_files(patch: Patch, new_dir: str):
   """Delete any files or symlinks in the new directory but not in the old directory."""
+  new_prefix = os.path.join(new_dir, '')
   for file in patch.extra_files:
-    file_path = os.path.join(new_dir, file)
+    file_path = new_prefix + file
     if os.path.isfile(file_path) or os.path.islink(file_path):
       os.remove(file_path)
     elif os.path.isdir(file_path):
       os.rmdir(file_path)
 
-## Rolling hash
-#  start with a fixed-size window that slides over the stream of data, one chunk at a time. 
-#  As the window moves, you update the hash value by taking into account the new chunk of data that has been added to the window and the old chunk of data that has been removed from the window.    
-class RollingHash:
-  def __init__(self, window_size=1024, prime=1000000007):
-    self.window_size = window_size
-    self.prime = prime
-    self.hash_value = 0
-    self.window = b''
+## Strong hash
+def strong_hash(data: bytes) -> bytes:
+    # Strong hash identifying a chunk, BLAKE3 (SIMD) when installed
+    if blake3 is not None:
+        return blake3.blake3(data).digest(length=STRONG_DIGEST_SIZE)
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
 
-  def update(self, new_chunk, old_chunk):
-    self.window = self.window[len(old_chunk):] + new_chunk
-    self.hash_value = (self.hash_value * self.prime + new_chunk) % self.prime
-    self.hash_value = (self.hash_value - old_chunk * pow(self.prime, self.window_size, self.prime)) % self.prime
 
-  def strong_hash(self):
-    # Return a strong hash value based on the current window
-    return self.hash_value
+def strong_hash_chunks(view: memoryview, bounds: List[Tuple[int, int]]) -> List[bytes]:
+    return [strong_hash(view[start:end]) for start, end in bounds]
 
 
 ## DIFF
-def diff_files(old_file_path: str, new_file_path: str) -> List[Operation]:
+@contextmanager
+def map_file(file_path: str):
+    """Map a file read-only; empty files (which mmap refuses) map to b''."""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def chunk_file(view: memoryview) -> Tuple[List[Tuple[int, int]], List[bytes]]:
+    """Cut a mapped file into content-defined chunks; returns their (start, end) offsets and strong hashes."""
+    bounds = []
+    start = 0
+    for end in find_cut_points(view, ROLLING_BASE, ROLLING_BASE_POW, ROLLING_PRIME, CHUNK_WINDOW, CHUNK_MASK, CHUNK_MIN_SIZE, CHUNK_MAX_SIZE):
+        bounds.append((start, end))
+        start = end
+    if len(bounds) < PARALLEL_HASH_CHUNKS:
+        return bounds, strong_hash_chunks(view, bounds)
+    # Hash one contiguous slice of chunks per worker, the hash functions release the GIL on chunk-sized inputs
+    step = -(-len(bounds) // WORKERS)
+    strong_hashes = []
+    for hashes in HASH_POOL.map(lambda first: strong_hash_chunks(view, bounds[first:first + step]), range(0, len(bounds), step)):
+        strong_hashes.extend(hashes)
+    return bounds, strong_hashes
+
+
+def build_chunk_index(old) -> Dict[bytes, Tuple[int, int]]:
+    """Index the chunks of the old file by strong hash -> (offset, length)."""
+    chunk_index = {}
+    with memoryview(old) as view:
+        bounds, strong_hashes = chunk_file(view)
+    for (start, end), strong in zip(bounds, strong_hashes):
+        chunk_index.setdefault(strong, (start, end - start))
+    return chunk_index
+
+
+def diff_files(old_file_path: str, new_file_path: str, target_path: str = '') -> List[Operation]:
     operations = []
 
-    # Open the old and new files
-    with open(old_file_path, 'rb') as old_file, open(new_file_path, 'rb') as new_file:
-        old_chunk = old_file.read(BLOCK_SIZE)
-        new_chunk = new_file.read(BLOCK_SIZE)
-        block_index = 0
-        # Compare the files chunk by chunk
-        while old_chunk or new_chunk:
-            if old_chunk == new_chunk:
-                # The chunks are the same, move to the next chunk
-                block_index += 1
-                old_chunk = old_file.read(BLOCK_SIZE)
-                new_chunk = new_file.read(BLOCK_SIZE)
+    with map_file(old_file_path) as old, map_file(new_file_path) as new, memoryview(new) as new_view:
+        chunk_index = build_chunk_index(old)
+        bounds, strong_hashes = chunk_file(new_view)
+        literal_buf = bytearray()
+        for (start, end), strong in zip(bounds, strong_hashes):
+            match = chunk_index.get(strong)
+            if match is None:
+                literal_buf += new_view[start:end]
+                continue
+            if literal_buf:
+                operations.append(Operation(OperationType.DATA, data=bytes(literal_buf), target_path=target_path))
+                literal_buf.clear()
+            block_offset, block_length = match
+            last = operations[-1] if operations else None
+            if last is not None and last.op_type == OperationType.BLOCK_RANGE and last.block_offset + last.block_length == block_offset:
+                # Consecutive old chunks, extend the previous range
+                last.block_length += block_length
             else:
-                # The chunks are different, find the next matching chunk
-                matching_block_index = find_next_matching_block(old_file, new_file, old_chunk, new_chunk)
-                if matching_block_index is not None:
-                    # A matching chunk was found, create a BLOCK_RANGE operation for the blocks in between
-                    block_span = matching_block_index - block_index
-                    operations.append(Operation(OperationType.BLOCK_RANGE, block_index=block_index, block_span=block_span))
-                    block_index = matching_block_index
-                    old_file.seek(block_index * BLOCK_SIZE)
-                    new_file.seek(block_index * BLOCK_SIZE)
-                    old_chunk = old_file.read(BLOCK_SIZE)
-                    new_chunk = new_file.read(BLOCK_SIZE)
-                else:
-                    # No matching chunk was found, create a DATA operation for the rest of the new file
-                    operations.append(Operation(OperationType.DATA, data=new_file.read()))
-                    break
+                operations.append(Operation(OperationType.BLOCK_RANGE, block_offset=block_offset, block_length=block_length, target_path=target_path))
+        if literal_buf or not operations:
+            # An empty new file still needs an operation to be created
+            operations.append(Operation(OperationType.DATA, data=bytes(literal_buf), target_path=target_path))
     return operations
 
 def diff(old_dir: str, new_dir: str) -> Patch:
-    # Scan the old and new directories
-    old_dirs, old_files = scan_dir(old_dir)
-    new_dirs, new_files = scan_dir(new_dir)
-
-    # Find the deleted and extra files
-    deleted_files = set(old_files) - set(new_files)
-    extra_files = set(new_files) - set(old_files)
-
-    # Initialize the list of operations
-    operations = []
-
-    # Process the deleted files
-    for file in deleted_files:
-        operations.append(Operation(OperationType.DELETE, target_path=file))
-
-    # Process the extra files
-    for file in extra_files:
-        file_path = os.path.join(new_dir, file)
-        if os.path.islink(file_path):
-            # File is a symlink, add a SYMLINK operation
-            with open(file_path, 'r') as f:
-                target_path = f.read()
-            operations.append(Operation(OperationType.SYMLINK, target_path=target_path))
-        elif os.path.isdir(file_path):
-            # File is a directory, add a MKDIR operation
-
-            operations.append(Operation(OperationType.MKDIR, target_path=file))
-        else:
-            # File is a regular file, add a DATA operation
-            with open(file_path, 'rb') as f:
-                data = f.read()
-            operations.append(Operation(OperationType.DATA, data=data, target_path=file))
-
-    # Process the common files
-    common_files = set(old_files) & set(new_files)
-    for file in common_files:
-        old_file_path = os.path.join(old_dir, file)
-        new_file_path = os.path.join(new_dir, file)
-        if os.path.islink(old_file_path) or os.path.islink(new_file_path):
-            # File is a symlink, add a SYMLINK operation
-            with open(new_file_path, 'r') as f:
-                target_path = f.read()
-            operations.append(Operation(OperationType.SYMLINK, target_path=target_path))
-        elif os.path.isdir(old_file_path) or os.path.isdir(new_file_path):
-            # File is a directory, add a MKDIR operation
-            operations.append(Operation(OperationType.MKDIR, target_path=file))
-        else:
-            # File is a regular file, compare the contents
-            with open(old_file_path, 'rb') as old_file:
-                with open(new_file_path, 'rb') as new_file:
-                    old_chunk = old_file.read(BLOCK_SIZE)
-
-                    new_chunk = new_file.read(BLOCK_SIZE)
-                    # print number of chunnks in both files
-                    
-
-                    while old_chunk and new_chunk:
-                        if old_chunk != new_chunk:
-                            # Find the next matching block in the new file
-                            matching_block = find_next_matching_block(old_chunk, new_file)
-                            if matching_block:
-                                # Add a BLOCK_RANGE operation
-                                block_index = new_file.tell() // BLOCK_SIZE - 1
-                                block_span = len(matching_block) // BLOCK_SIZE
-                                operations.append(Operation(OperationType.BLOCK_RANGE, block_index=block_index, block_span=block_span, target_path=file))
-                                new_chunk = matching_block + new_file.read(BLOCK_SIZE)
-                            else:
-                                # Add a DATA operation
-                                operations.append(Operation(OperationType.DATA, data=new_chunk, target_path=file))
-                                break
-                        old_chunk = old_file.read(BLOCK_SIZE)
-                        new_chunk = new_file.read(BLOCK_SIZE)
-                    else:
-                        if not old_chunk and new_chunk:
-                            # Add a DATA operation for the remaining data in the new file
-                            operations.append(Operation(OperationType.DATA, data=new_chunk, target_path=file))
+    old_dirs = []
+    new_dirs = []
+    deleted_files = []
+    extra_files = []
+
+    # Initialize the operation columns
+    operations = OperationColumns()
+
+    # Walk both directories in lockstep; common files are diffed on the pool with a bounded number in flight
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        pending = deque()
+        for file, old_entry, new_entry in walk_trees(old_dir, new_dir):
+            old_is_dir = old_entry is not None and old_entry.is_dir()
+            new_is_dir = new_entry is not None and new_entry.is_dir()
+            if old_is_dir:
+                old_dirs.append(file)
+            if new_is_dir:
+                new_dirs.append(file)
+            old_is_file = old_entry is not None and not old_is_dir and old_entry.is_file()
+            new_is_file = new_entry is not None and not new_is_dir and new_entry.is_file()
+            if old_is_file and new_is_file:
+                # Process the common files
+                if not old_entry.is_symlink() and not new_entry.is_symlink():
+                    old_stat, new_stat = old_entry.stat(), new_entry.stat()
+                    if old_stat.st_size == new_stat.st_size and old_stat.st_mtime_ns == new_stat.st_mtime_ns:
+                        # Same size and mtime, assume the file is unchanged and copy it whole without reading it
+                        if new_stat.st_size:
+                            operations.append(Operation(OperationType.BLOCK_RANGE, block_offset=0, block_length=new_stat.st_size, target_path=file))
+                        else:
+                            operations.append(Operation(OperationType.DATA, target_path=file))
+                        continue
+                pending.append(pool.submit(diff_one, file, old_dir, new_dir))
+                if len(pending) >= WORKERS * 4:
+                    operations.extend(pending.popleft().result())
+            elif old_is_file:
+                # Process the deleted files
+                deleted_files.append(file)
+                operations.append(Operation(OperationType.DELETE, target_path=file))
+            elif new_is_file:
+                # Process the extra files
+                extra_files.append(file)
+                operations.extend(extra_one(file, new_dir))
+        while pending:
+            operations.extend(pending.popleft().result())
     # Return the patch
-    return Patch(old_dirs=old_dirs, new_dirs=new_dirs, deleted_files=deleted_files, extra_files=extra_files, operations=operations)
+    return Patch(old_dirs=old_dirs, new_dirs=new_dirs, deleted_files=deleted_files, extra_files=extra_files, operations=operations, source_dir=new_dir)
 
 
-def scan_dir(dir_path: str) -> tuple[List[str], List[str]]:
-    dirs = []
-    files = []
-    for entry in os.scandir(dir_path):
-        if entry.is_dir():
-            dirs.append(entry.name)
-        elif entry.is_file():
-            files.append(entry.name)
-    return dirs, files
+def extra_one(file: str, new_dir: str) -> List[Operation]:
+    """Compute the operations for a file only present in the new directory."""
+    file_path = os.path.join(new_dir, file)
+    if os.path.islink(file_path):
+        # File is a symlink, add a SYMLINK operation
+        target_path = os.readlink(file_path)
+        return [Operation(OperationType.SYMLINK, target_path=target_path)]
+    elif os.path.isdir(file_path):
+        # File is a directory, add a MKDIR operation
+        return [Operation(OperationType.MKDIR, target_path=file)]
+    else:
+        # File is a regular file, add a DATA operation that copies it when the patch is applied
+        return [Operation(OperationType.DATA, target_path=file, src_path=file)]
+
+
+def diff_one(file: str, old_dir: str, new_dir: str) -> List[Operation]:
+    """Compute the operations for a file present in both directories."""
+    old_file_path = os.path.join(old_dir, file)
+    new_file_path = os.path.join(new_dir, file)
+    if os.path.islink(new_file_path):
+        # File is a symlink, add a SYMLINK operation
+        target_path = os.readlink(new_file_path)
+        return [Operation(OperationType.SYMLINK, target_path=target_path)]
+    elif os.path.islink(old_file_path):
+        # A symlink became a regular file, there is nothing to diff against; copy it like an extra file
+        return [Operation(OperationType.DATA, target_path=file, src_path=file)]
+    elif os.path.isdir(old_file_path) or os.path.isdir(new_file_path):
+        # File is a directory, add a MKDIR operation
+        return [Operation(OperationType.MKDIR, target_path=file)]
+    else:
+        # File is a regular file, compare the contents
+        return diff_files(old_file_path, new_file_path, target_path=file)
+
+
+def scan_dir(dir_path: str, rel_path: str = '') -> Iterator[Tuple[str, os.DirEntry]]:
+    """Lazily walk dir_path depth-first in name order, yielding (path relative to dir_path, entry); symlinked directories are not followed."""
+    with os.scandir(os.path.join(dir_path, rel_path)) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        entry_path = os.path.join(rel_path, entry.name) if rel_path else entry.name
+        yield entry_path, entry
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_dir(dir_path, entry_path)
+
+
+def walk_trees(old_dir: str, new_dir: str) -> Iterator[Tuple[str, Optional[os.DirEntry], Optional[os.DirEntry]]]:
+    """Walk both directories in lockstep, yielding (relative path, old entry, new entry) with None for a missing side."""
+    # scan_dir yields in path component order, so a two-way merge on the split path classifies every entry in one pass
+    old_iter, new_iter = scan_dir(old_dir), scan_dir(new_dir)
+    old_path, old_entry = next(old_iter, (None, None))
+    new_path, new_entry = next(new_iter, (None, None))
+    old_key = old_path.split(os.sep) if old_path is not None else None
+    new_key = new_path.split(os.sep) if new_path is not None else None
+    while old_key is not None or new_key is not None:
+        if new_key is None or (old_key is not None and old_key < new_key):
+            yield old_path, old_entry, None
+            advance_old, advance_new = True, False
+        elif old_key is None or new_key < old_key:
+            yield new_path, None, new_entry
+            advance_old, advance_new = False, True
+        else:
+            yield new_path, old_entry, new_entry
+            advance_old = advance_new = True
+        if advance_old:
+            old_path, old_entry = next(old_iter, (None, None))
+            old_key = old_path.split(os.sep) if old_path is not None else None
+        if advance_new:
+            new_path, new_entry = next(new_iter, (None, None))
+            new_key = new_path.split(os.sep) if new_path is not None else None
 
 # def apply_patch(patch: Patch, old_dir: str, staging_dir: str) -> None:
 #     # Create any missing directories in the staging directory
@@ -248,45 +582,17 @@ def apply_patch(patch, old_dir, new_dir):
     # Create the staging directory
     staging_dir = tempfile.mkdtemp()
 
-    print(f'Apply patch staging_dir: {staging_dir}')
-    print(f'Apply patch new_dir: {new_dir}')
-    print(f'Apply patch old_dir: {old_dir}')
+    logger.debug('Apply patch staging_dir: %s new_dir: %s old_dir: %s', staging_dir, new_dir, old_dir)
     # Create any missing directories in the staging directory
     create_missing_dirs(patch, staging_dir)
     # Apply the operations in the patch to the old directory and write the results to the staging directory
-    for operation in patch.operations:
-        print(f'Applying operation to {operation.target_path}', operation.op_type, operation.data, old_dir, new_dir, staging_dir)
-        if operation.op_type == OperationType.DATA:
-            # Write the data to the new file
-            new_file_path = os.path.join(staging_dir, operation.target_path)
-            with open(new_file_path, 'wb') as f:
-                f.write(operation.data)
-        elif operation.op_type == OperationType.BLOCK_RANGE:
-            # Open the old file and seek to the correct offset
-            old_file_path = os.path.join(old_dir, operation.target_path)
-            with open(old_file_path, 'rb') as old_file:
-                old_file.seek(operation.block_index * BLOCK_SIZE)
-                # Read the specified number of blocks from the old file
-                data = old_file.read(operation.block_span * BLOCK_SIZE)
-            # Write the block range to the new file
-            new_file_path = os.path.join(staging_dir, operation.target_path)
-            with open(new_file_path, 'wb') as f:
-                f.write(data)
+    apply_operations(patch, old_dir, staging_dir)
     # Delete any extra files in the new directory
     delete_extra_files(patch, new_dir)
     # Replace the old directory with the new directory
     shutil.rmtree(new_dir)
     shutil.move(staging_dir, new_dir)
 
-def find_next_matching_block(old_chunk: bytes, new_file: BinaryIO) -> Optional[bytes]:
-    new_chunk = new_file.read(BLOCK_SIZE)
-    while new_chunk:
-        if old_chunk == new_chunk:
-            return new_chunk
-        new_chunk = new_file.read(BLOCK_SIZE)
-    return None
-
-
 def main():
     # Set the paths for the old and new directories
     old_dir = r"""C:/Users/lion-/Documents/Python/test/oldfolder"""
@@ -296,7 +602,9 @@ def main():
 
     # Calculate the patch for the two directories
     patch = diff(old_dir, reference_dir)
-    patch_size = sum(len(operation.data) for operation in patch.operations)
+    # DATA copied from the new directory is not loaded, count its file size instead
+    source_prefix = os.path.join(patch.source_dir, '')
+    patch_size = sum(os.path.getsize(source_prefix + operation.src_path) if operation.src_path else len(operation.data) for operation in patch.operations)
     print(f'Patch size: {patch_size} bytes')
 
 
@@ -305,10 +613,11 @@ def main():
         if operation.op_type  == OperationType.DATA:
             print(f'DATA operation with {len(operation.data)} bytes of data')
         elif operation.op_type == OperationType.BLOCK_RANGE:
-            print(f'BLOCK_RANGE operation with file_index={operation.file_index}, block_index={operation.block_index}, and block_span={operation.block_span}')
+            print(f'BLOCK_RANGE operation with file_index={operation.file_index}, block_offset={operation.block_offset}, and block_length={operation.block_length}')
 
     # Apply the patch to the destination directory
     apply_patch(patch, old_dir, destination_dir)
     print("Patch applied successfully")
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from diff import CHUNK_MAX_SIZE, PARALLEL_HASH_CHUNKS, apply_patch, diff, Operation, OperationColumns, OperationType, Patch, PatchFormatError, SECTION_LENGTH, dump_patch, load_patch
+
+
+def make_patch() -> Patch:
+    operations = OperationColumns()
+    operations.append(Operation(OperationType.DELETE, target_path='gone.txt'))
+    operations.append(Operation(OperationType.BLOCK_RANGE, block_offset=4096, block_length=8192, target_path='sub/file.bin'))
+    operations.append(Operation(OperationType.DATA, data=b'new bytes', target_path='sub/file.bin'))
+    operations.append(Operation(OperationType.DATA, data=b'', target_path='empty'))
+    return Patch(old_dirs=['sub'], new_dirs=['sub', 'sub/new'], deleted_files=['gone.txt'], extra_files=[], operations=operations)
+
+
+def dump(patch: Patch) -> bytes:
+    f = io.BytesIO()
+    dump_patch(patch, f)
+    return f.getvalue()
+
+
+class PatchFormatTest(unittest.TestCase):
+    def test_round_trip(self):
+        patch = make_patch()
+        loaded = load_patch(io.BytesIO(dump(patch)))
+        self.assertEqual(loaded.old_dirs, patch.old_dirs)
+        self.assertEqual(loaded.new_dirs, patch.new_dirs)
+        self.assertEqual(loaded.deleted_files, patch.deleted_files)
+        self.assertEqual(loaded.extra_files, patch.extra_files)
+        for loaded_op, op in zip(loaded.operations, patch.operations, strict=True):
+            self.assertEqual(loaded_op.op_type, op.op_type)
+            self.assertEqual(loaded_op.target_path, op.target_path)
+            self.assertEqual(loaded_op.block_offset, op.block_offset)
+            self.assertEqual(loaded_op.block_length, op.block_length)
+            self.assertEqual(bytes(loaded_op.data), op.data)
+
+    def test_non_utf8_names_round_trip(self):
+        name = 'caf\udce9'
+        patch = Patch(old_dirs=[], new_dirs=[name], deleted_files=[], extra_files=[], operations=OperationColumns())
+        self.assertEqual(load_patch(io.BytesIO(dump(patch))).new_dirs, [name])
+
+    def test_truncated_section_length(self):
+        data = dump(make_patch())
+        blob_length = sum(len(data) for data in make_patch().operations.data)
+        # Cut the file in the middle of the blob's length field
+        with self.assertRaises(PatchFormatError):
+            load_patch(io.BytesIO(data[:-(blob_length + SECTION_LENGTH.size - 3)]))
+
+    def test_shrunk_blob(self):
+        data = bytearray(dump(make_patch()))
+        # Rewrite the blob section as one byte shorter than the offsets say
+        blob_length = sum(len(data) for data in make_patch().operations.data)
+        blob_start = len(data) - blob_length
+        data[blob_start - SECTION_LENGTH.size:blob_start] = SECTION_LENGTH.pack(blob_length - 1)
+        with self.assertRaises(PatchFormatError):
+            load_patch(io.BytesIO(bytes(data[:-1])))
+
+    def test_unknown_op_type(self):
+        patch = make_patch()
+        patch.operations.op_type[0] = 9
+        with self.assertRaises(PatchFormatError):
+            load_patch(io.BytesIO(dump(patch)))
+
+    def test_negative_block_range(self):
+        for column in ('block_offset', 'block_length'):
+            patch = make_patch()
+            getattr(patch.operations, column)[1] = -1
+            with self.assertRaises(PatchFormatError):
+                load_patch(io.BytesIO(dump(patch)))
+
+    def test_bad_magic(self):
+        with self.assertRaises(PatchFormatError):
+            load_patch(io.BytesIO(b'XXXX' + dump(make_patch())[4:]))
+
+
+def write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read_tree(root: str) -> dict:
+    """Map every directory and file under root to None or its contents."""
+    tree = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in dir_names:
+            tree[os.path.relpath(os.path.join(dir_path, name), root)] = None
+        for name in file_names:
+            with open(os.path.join(dir_path, name), 'rb') as f:
+                tree[os.path.relpath(os.path.join(dir_path, name), root)] = f.read()
+    return tree
+
+
+class DiffApplyTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.old_dir = os.path.join(tmp.name, 'old')
+        self.new_dir = os.path.join(tmp.name, 'new')
+        self.tmp = tmp.name
+        rng = random.Random(0)
+        old, new = self.old_dir, self.new_dir
+
+        # Enough chunks to be hashed on HASH_POOL, with an insertion and a deletion
+        big = rng.randbytes(max(PARALLEL_HASH_CHUNKS * 8 * 1024 * 2, 2 * CHUNK_MAX_SIZE))
+        write(os.path.join(old, 'big.bin'), big)
+        write(os.path.join(new, 'big.bin'), big[:100000] + b'inserted' + big[100000:700000] + big[701000:])
+        # Same size and mtime, taken whole without diffing
+        write(os.path.join(old, 'same.txt'), b'unchanged')
+        shutil.copy2(os.path.join(old, 'same.txt'), os.path.join(new, 'same.txt'))
+        write(os.path.join(old, 'empty'), b'')
+        write(os.path.join(new, 'empty'), b'')
+        write(os.path.join(old, 'emptied'), b'soon gone')
+        write(os.path.join(new, 'emptied'), b'')
+        write(os.path.join(new, 'added/nested/new.txt'), b'only in new')
+        write(os.path.join(old, 'deleted.txt'), b'only in old')
+        # A directory that becomes a file and a file that becomes a directory
+        write(os.path.join(old, 'swap/inner.txt'), b'inner')
+        write(os.path.join(new, 'swap'), b'now a file')
+        write(os.path.join(old, 'swap2'), b'was a file')
+        write(os.path.join(new, 'swap2/inner.txt'), b'now a dir')
+        # A symlink that becomes a regular file
+        write(os.path.join(old, 'link_target.txt'), b'target')
+        write(os.path.join(new, 'link_target.txt'), b'target')
+        os.symlink('link_target.txt', os.path.join(old, 'link'))
+        write(os.path.join(new, 'link'), b'no longer a link')
+
+    def apply(self, patch, name: str) -> dict:
+        dst = os.path.join(self.tmp, name)
+        os.makedirs(dst)
+        apply_patch(patch, self.old_dir, dst)
+        return read_tree(dst)
+
+    def test_apply_in_memory(self):
+        patch = diff(self.old_dir, self.new_dir)
+        # The edited large file is mostly rebuilt from old chunks
+        big_data = sum(len(op.data) for op in patch.operations if op.target_path == 'big.bin')
+        self.assertLess(big_data, 5 * CHUNK_MAX_SIZE)
+        self.assertEqual(self.apply(patch, 'dst'), read_tree(self.new_dir))
+
+    def test_apply_after_dump_and_load(self):
+        f = io.BytesIO()
+        dump_patch(diff(self.old_dir, self.new_dir), f)
+        f.seek(0)
+        self.assertEqual(self.apply(load_patch(f), 'dst'), read_tree(self.new_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()